@@ -1,6 +1,132 @@
 import numpy as np
-from scipy.signal import find_peaks, butter, filtfilt
-from scipy.interpolate import interp1d
+from functools import lru_cache
+from numba import njit, prange
+from scipy.signal import butter, sosfilt_zi, tf2sos
+
+@lru_cache(maxsize=8)
+def bandpass_coefs(fs_interp):
+    """Butterworth second-order sections and sosfiltfilt initial state isolating the HF band (0.15-0.4 Hz) at fs_interp"""
+    nyquist = fs_interp / 2
+    sos = butter(2, [0.15 / nyquist, 0.4 / nyquist], btype='band', output='sos')
+    return sos, sosfilt_zi(sos)
+
+@lru_cache(maxsize=8)
+def ecg_clean_coefs(sample_rate, powerline=50):
+    """
+    Second-order sections and sosfiltfilt initial states of NeuroKit's ECG cleaning ('neurokit' method):
+    a 5th-order 0.5 Hz Butterworth high-pass, then a moving average over one powerline period
+    """
+    highpass = butter(5, 0.5, btype='highpass', output='sos', fs=sample_rate)
+    taps = int(sample_rate / powerline) if sample_rate >= 100 else 2
+    smooth = tf2sos(np.ones(taps) / taps, [1.0])
+    return (highpass, sosfilt_zi(highpass)), (smooth, sosfilt_zi(smooth))
+
+@njit('f4[:](i8, f8, f4[:], f4[:])', cache=True, fastmath=True, error_model='numpy')
+def _interp_linear(n, dx, xp, fp):
+    """Linear interpolation at the uniform grid i*dx (i < n) over sorted xp, extrapolating linearly past both ends"""
+    y = np.empty(n, dtype=np.float32)
+    j = 0
+    last = len(xp) - 2
+    slope = (float(fp[1]) - fp[0]) / (float(xp[1]) - xp[0])
+    for i in range(n):
+        # The grid is generated on the fly, and being sorted the bracketing segment only moves forward;
+        # its slope is recomputed only when it does, so the two end segments extrapolate with one slope each
+        x = i * dx
+        if j < last and x > xp[j + 1]:
+            while j < last and x > xp[j + 1]:
+                j += 1
+            slope = (float(fp[j + 1]) - fp[j]) / (float(xp[j + 1]) - xp[j])
+        y[i] = fp[j] + (x - xp[j]) * slope
+    return y
+
+@njit('f4[:](f8[:, :], f4[:], f8[:, :])', cache=True, fastmath=True)
+def _sosfilt(sos, x, z):
+    """Cascade of direct form II transposed biquads (a0 == 1), updating the per-section state z in place"""
+    y = np.empty(len(x), dtype=np.float32)
+    for i in range(len(x)):
+        xi = float(x[i])
+        for s in range(sos.shape[0]):
+            yi = sos[s, 0] * xi + z[s, 0]
+            z[s, 0] = sos[s, 1] * xi - sos[s, 4] * yi + z[s, 1]
+            z[s, 1] = sos[s, 2] * xi - sos[s, 5] * yi
+            xi = yi
+        y[i] = xi
+    return y
+
+@njit('f4[:](f8[:, :], f8[:, :], f4[:])', cache=True, fastmath=True)
+def _sosfiltfilt(sos, zi, x):
+    """Zero-phase filtering, equivalent to scipy.signal.sosfiltfilt(sos, x) with its default odd padding"""
+    ntaps = 2 * sos.shape[0] + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    padlen = 3 * ntaps
+    n = len(x)
+    ext = np.empty(n + 2 * padlen, dtype=np.float32)
+    for i in range(padlen):
+        ext[i] = 2 * x[0] - x[padlen - i]
+        ext[n + padlen + i] = 2 * x[n - 1] - x[n - 2 - i]
+    ext[padlen:padlen + n] = x
+
+    y = _sosfilt(sos, ext, zi * ext[0])
+    y = _sosfilt(sos, y[::-1], zi * y[-1])
+    return y[::-1][padlen:padlen + n].copy()
+
+def clean_ecg(ecg, sample_rate=100):
+    """
+    Float32 equivalent of nk.ecg_clean(ecg, sampling_rate=sample_rate) for ECG without missing samples.
+    Each stage is filtered forward and backward separately, as NeuroKit does, so the padding matches.
+    """
+    ecg = np.asarray(ecg, dtype=np.float32)
+    stages = ecg_clean_coefs(sample_rate)
+    if len(ecg) <= 3 * (2 * max(len(sos) for sos, _ in stages) + 1):
+        raise ValueError("ECG signal is too short to filter")
+    for sos, zi in stages:
+        ecg = _sosfiltfilt(sos, zi, ecg)
+    return ecg
+
+@njit('UniTuple(i8[:], 2)(f4[:])', cache=True, fastmath=True)
+def _local_extrema(x):
+    """Indices of samples strictly above (maxima) or below (minima) both neighbours"""
+    max_peaks = np.empty(len(x), dtype=np.int64)
+    min_peaks = np.empty(len(x), dtype=np.int64)
+    n_max = 0
+    n_min = 0
+    # Branchless: always write the candidate index, advance the cursor only on a match
+    for i in range(1, len(x) - 1):
+        max_peaks[n_max] = i
+        n_max += (x[i] > x[i - 1]) & (x[i] > x[i + 1])
+        min_peaks[n_min] = i
+        n_min += (x[i] < x[i - 1]) & (x[i] < x[i + 1])
+    return max_peaks[:n_max], min_peaks[:n_min]
+
+@njit('f8(f4[:], i8[:], i8[:])', cache=True, fastmath=True)
+def _envelope_area(x, max_peaks, min_peaks):
+    """
+    Trapezoidal area (dx = 1 sample) between the upper and lower envelopes of x, clipped to [-0.1, 0.1].
+    Envelope values are interpolated and summed as they are generated, so neither envelope is stored.
+    Slopes are computed once per segment; the first and last segment extrapolate past the outer extrema.
+    """
+    n = len(x)
+    last_max = len(max_peaks) - 2
+    last_min = len(min_peaks) - 2
+    j_max = 0
+    j_min = 0
+    slope_max = (float(x[max_peaks[1]]) - x[max_peaks[0]]) / (max_peaks[1] - max_peaks[0])
+    slope_min = (float(x[min_peaks[1]]) - x[min_peaks[0]]) / (min_peaks[1] - min_peaks[0])
+    area = 0.0
+    for i in range(n):
+        # Strict extrema are never adjacent, so each cursor advances at most one segment per sample
+        if j_max < last_max and i > max_peaks[j_max + 1]:
+            j_max += 1
+            slope_max = (float(x[max_peaks[j_max + 1]]) - x[max_peaks[j_max]]) / (max_peaks[j_max + 1] - max_peaks[j_max])
+        upper = x[max_peaks[j_max]] + (i - max_peaks[j_max]) * slope_max
+
+        if j_min < last_min and i > min_peaks[j_min + 1]:
+            j_min += 1
+            slope_min = (float(x[min_peaks[j_min + 1]]) - x[min_peaks[j_min]]) / (min_peaks[j_min + 1] - min_peaks[j_min])
+        lower = x[min_peaks[j_min]] + (i - min_peaks[j_min]) * slope_min
+
+        diff = min(max(upper, -0.1), 0.1) - min(max(lower, -0.1), 0.1)
+        area += diff if 0 < i < n - 1 else 0.5 * diff
+    return area
 
 def calculate_area_segment(r_peaks, sampling_rate=100, fs_interp=4):
     """
@@ -15,82 +141,166 @@ def calculate_area_segment(r_peaks, sampling_rate=100, fs_interp=4):
     - ani_value: float, ANI value between 0 and 100
     - visualization_data: dict, additional data for visualization
     """
+    r_peaks = np.asarray(r_peaks, dtype=np.int64)
+    if len(r_peaks) < 3:
+        raise ValueError("At least 3 R peaks are needed to interpolate RR intervals")
+    sos, zi = bandpass_coefs(fs_interp)
+
     # Calculate R-R intervals
     rr_intervals = calculate_rr_intervals(r_peaks, sampling_rate)
+    if not np.all(np.isfinite(rr_intervals)):
+        raise ValueError("RR intervals cannot be normalized (constant RR)")
     
     # Convert to evenly sampled time series
     rr_times, rr_interpolated = interpolate_rr(r_peaks, rr_intervals, sampling_rate, fs_interp)
     
     # Filter in HF band and analyze in time domain
-    upper_envelope, lower_envelope, rr_hf = analyze_hf_time_domain(rr_interpolated, fs_interp)
+    upper_envelope, lower_envelope, rr_hf = analyze_hf_time_domain(rr_interpolated, fs_interp, sos, zi)
     
     return upper_envelope, lower_envelope, rr_hf
 
 
+@njit('f4[:](i8[:], i8)', cache=True)
 def calculate_rr_intervals(r_peaks, sampling_rate):
-    """Calculate R-R intervals in seconds"""
-    rr_intervals = np.diff(r_peaks) / sampling_rate
-    # Normalize
-    rr_intervals = rr_intervals - np.mean(rr_intervals)
-    rr_intervals = rr_intervals / np.sqrt(np.sum(rr_intervals**2))
+    """
+    Normalized R-R interval series: zero mean and unit norm, so unitless. NaN if all intervals are equal.
+    sampling_rate is ignored, since the normalization cancels the sample-to-second scaling; it is kept
+    for API compatibility.
+    """
+    # The normalization below cancels the 1/sampling_rate scaling, so work on the raw
+    # peak differences: sums over integer indices are exact, avoiding cancellation
+    n = len(r_peaks) - 1
+    diffs = np.empty(n, dtype=r_peaks.dtype)
+    total = 0
+    total_sq = 0
+    for i in range(n):
+        d = r_peaks[i + 1] - r_peaks[i]
+        diffs[i] = d
+        total += d
+        total_sq += d * d
+    # Normalize: (d - mean) / sqrt(sum((d - mean)**2)), scaled through by n
+    rr_intervals = np.empty(n, dtype=np.float32)
+    sum_sq_dev = n * (n * total_sq - total * total)
+    scale = 1 / np.sqrt(sum_sq_dev) if sum_sq_dev > 0 else np.nan  # constant RR: 0/0 as before
+    for i in range(n):
+        rr_intervals[i] = (n * diffs[i] - total) * scale
     return rr_intervals
 
+@njit('f4[:](i8[:], f4[:], i8, i8)', cache=True)
+def _resample_rr(r_peaks, rr_intervals, sampling_rate, fs_interp):
+    """RR intervals linearly interpolated onto the 64-second grid at fs_interp, without building the grid"""
+    # Get timestamps for each RR interval (midpoint between R peaks)
+    rr_times = np.empty(len(rr_intervals), dtype=np.float32)
+    for i in range(len(rr_intervals)):
+        rr_times[i] = r_peaks[i] / sampling_rate + rr_intervals[i] / 2
+
+    return _interp_linear(64 * fs_interp + 1, 1 / fs_interp, rr_times, rr_intervals)
+
+@njit('UniTuple(f4[:], 2)(i8[:], f4[:], i8, i8)', cache=True)
 def interpolate_rr(r_peaks, rr_intervals, sampling_rate, fs_interp):
     """Interpolate RR intervals to create evenly sampled time series"""
-    # Get timestamps for each R peak in seconds
-    r_times = r_peaks / sampling_rate
+    rr_interp = _resample_rr(r_peaks, rr_intervals, sampling_rate, fs_interp)
     
-    # Get timestamps for each RR interval (midpoint between R peaks)
-    rr_times = r_times[:-1] + rr_intervals/2
-    
-    # Create evenly sampled time series through interpolation (4 Hz)
-    t_interp = np.arange(0, 64+1/fs_interp, 1/fs_interp)
-    
-    interpolator = interp1d(rr_times, rr_intervals, kind='linear', bounds_error=False, fill_value='extrapolate')
-        
-    rr_interp = interpolator(t_interp)
+    # Timestamps of the evenly sampled series (4 Hz), only materialized for callers that plot it
+    t_interp = (np.arange(len(rr_interp)) / fs_interp).astype(np.float32)
     
     # Return both the timestamps and interpolated values
     return t_interp, rr_interp
 
-def analyze_hf_time_domain(rr_interp, fs_interp):
+@njit('UniTuple(f4[:], 3)(f4[:], i8, f8[:, :], f8[:, :])', cache=True)
+def analyze_hf_time_domain(rr_interp, fs_interp, sos, zi):
     """
     Analyze HF band in time domain to calculate ANI
     
     Parameters:
     - rr_interp: Interpolated RR intervals
-    - fs_interp: Interpolation frequency (Hz)
+    - fs_interp: Interpolation frequency (Hz). Unused, since the envelopes are built in sample units;
+      kept for API compatibility
+    - sos, zi: HF band-pass sections and initial state from bandpass_coefs
     
     Returns:
-    - ani_value: calculated ANI value
     - upper_envelope: upper envelope of the signal
     - lower_envelope: lower envelope of the signal
+    - rr_hf: the HF band-passed RR series
     """
     # Apply high-pass filter to isolate HF band (0.15-0.4 Hz)
-    nyquist = fs_interp / 2
-    low = 0.15 / nyquist
-    high = 0.4 / nyquist
-    b, a = butter(2, [low, high], btype='band')
-        
-    rr_hf = filtfilt(b, a, rr_interp)
+    rr_hf = _sosfiltfilt(sos, zi, rr_interp)
     
     # Find local maxima and minima to create the envelope
-    max_peaks, _ = find_peaks(rr_hf)
-    min_peaks, _ = find_peaks(-rr_hf)
+    max_peaks, min_peaks = _local_extrema(rr_hf)
+    if len(max_peaks) < 2 or len(min_peaks) < 2:
+        raise ValueError("At least 2 maxima and 2 minima are needed to build the envelopes")
     
-    # Create envelopes by interpolating between peaks
-    t = np.arange(len(rr_hf)) / fs_interp
+    # Create envelopes by interpolating between peaks (in sample units, so no time axis is needed)
+    n = len(rr_hf)
     
     # Upper envelope
-    upper_interp = interp1d(t[max_peaks], rr_hf[max_peaks], kind='linear', 
-                           bounds_error=False, fill_value='extrapolate')
-    upper_envelope = upper_interp(t)
+    upper_envelope = _interp_linear(n, 1.0, max_peaks.astype(np.float32), rr_hf[max_peaks])
     upper_envelope = np.clip(upper_envelope, -0.1, 0.1)  # Clip to [-0.1, 0.1]
 
     # Lower envelope
-    lower_interp = interp1d(t[min_peaks], rr_hf[min_peaks], kind='linear',
-                           bounds_error=False, fill_value='extrapolate')
-    lower_envelope = lower_interp(t)
+    lower_envelope = _interp_linear(n, 1.0, min_peaks.astype(np.float32), rr_hf[min_peaks])
     lower_envelope = np.clip(lower_envelope, -0.1, 0.1)  # Clip to [-0.1, 0.1]
     
-    return upper_envelope, lower_envelope, rr_hf
\ No newline at end of file
+    return upper_envelope, lower_envelope, rr_hf
+
+@njit('f8(i8[:], i8, i8, f8[:, :], f8[:, :])', cache=True)
+def compute_ani_window(peaks_rel, sample_rate, fs_interp, sos, zi):
+    """
+    Area between the HF envelopes of one 64-second window, in a single compiled call
+
+    Parameters:
+    - peaks_rel: R peak indices relative to the window start
+    - sample_rate: ECG sampling frequency (Hz)
+    - fs_interp: Interpolation frequency (Hz)
+    - sos, zi: HF band-pass sections and initial state from bandpass_coefs
+
+    Returns:
+    - area: trapezoidal area between the envelopes, NaN if the window has too few beats
+    """
+    if len(peaks_rel) < 3:
+        return np.nan
+    rr_intervals = calculate_rr_intervals(peaks_rel, sample_rate)
+    if not np.isfinite(rr_intervals[0]):
+        return np.nan
+    rr_interpolated = _resample_rr(peaks_rel, rr_intervals, sample_rate, fs_interp)
+    rr_hf = _sosfiltfilt(sos, zi, rr_interpolated)
+
+    max_peaks, min_peaks = _local_extrema(rr_hf)
+    if len(max_peaks) < 2 or len(min_peaks) < 2:
+        return np.nan
+    return _envelope_area(rr_hf, max_peaks, min_peaks) / fs_interp
+
+# No eager signature: compiling a parallel kernel starts Numba's thread pool, which must not
+# happen at import in a process that may fork. It compiles on first call, e.g. in warmup_ani
+@njit(parallel=True, cache=True)
+def compute_ani_all(peaks, nonfinite, sample_rate, fs_interp, sos, zi):
+    """
+    Envelope areas of every 64-second window, sliding by one second, computed in parallel
+
+    Parameters:
+    - peaks: sorted R peak indices over the whole recording
+    - nonfinite: running count of non-finite ECG samples, nonfinite[k] = count in ecg[:k]
+    - sample_rate: ECG sampling frequency (Hz)
+    - fs_interp: Interpolation frequency (Hz)
+    - sos, zi: HF band-pass sections and initial state from bandpass_coefs
+
+    Returns:
+    - areas: one area per second of recording, 0 where the window has non-finite samples,
+      fewer than four beats or no valid envelope
+    """
+    n_samples = len(nonfinite) - 1
+    window = 64 * sample_rate + 1
+    areas = np.zeros(n_samples // sample_rate, dtype=np.float32)
+    for i in prange(len(areas)):
+        start_idx = i * sample_rate
+        end_idx = min(start_idx + window, n_samples)
+        lo = np.searchsorted(peaks, start_idx)
+        hi = np.searchsorted(peaks, end_idx)
+        # Skip windows with non-finite samples or too few beats for an RR series
+        if nonfinite[end_idx] != nonfinite[start_idx] or hi - lo < 4:
+            continue
+        area = compute_ani_window(peaks[lo:hi] - start_idx, sample_rate, fs_interp, sos, zi)
+        if np.isfinite(area):
+            areas[i] = area
+    return areas
\ No newline at end of file
@@ -1,16 +1,21 @@
 import os
 import pyvital.filters.pleth_spi as f_spi
 import concurrent.futures
+import multiprocessing
 import argparse
+import numba
 import vitaldb
 
 # Import utility functions
 from utils import (
+    load_signals,
     prepare_ecg,
     prepare_ppg,
     calculate_spi,
     calculate_ani,
-    chunk_data_for_track
+    warmup_ani,
+    chunk_data_for_track,
+    copy_header
 )
 
 # Constants
@@ -26,27 +31,39 @@ NAN_THRESHOLD = 0.5  # Maximum proportion of NaN values allowed
 
 DATA_DIR = "data"
 OUTPUT_DIR = "out"
+IO_WORKERS = 2  # Threads loading and saving files alongside the worker processes
 
-def process_file(file_path):
-    """Process a single vital file to calculate HRV, SPI, and ANI"""
-    file_name = os.path.basename(file_path)
-    print(f"Processing {file_name}")
-    
+def load_file(file_path):
+    """Read a vital file and extract the ECG and PPG waveforms (I/O stage)"""
+    print(f"Processing {os.path.basename(file_path)}")
     vf = vitaldb.VitalFile(file_path)
+    ecg, ppg = load_signals(vf, sample_rate=SAMPLE_RATE)
+    return vf, ecg, ppg
+
+
+def compute_tracks(header, ecg, ppg):
+    """Clean ECG/PPG and calculate ANI and SPI (compute stage)
+
+    header is a track-less VitalFile carrying the recording's time range, so the stage
+    only ships the waveforms between processes. Returns a dict of the derived signals,
+    None for any that could not be calculated.
+    """
+    results = {'ecg_clean': None, 'ANI': None, 'ppg_clean': None, 'spi': None}
+
     # Prepare ECG data
     ecg, ecg_clean, error = prepare_ecg(
-        file_path, 
+        ecg, 
         sample_rate=SAMPLE_RATE,
         nan_threshold=NAN_THRESHOLD,
         max_threshold=ECG_MAX_THRESHOLD,
-        min_threshold=ECG_MIN_THRESHOLD
+        min_threshold=ECG_MIN_THRESHOLD,
+        file_path=header.ipath
     )
     
     if error:
         print(error)
     else:
-        recs = chunk_data_for_track(ecg_clean, vf, SAMPLE_RATE)
-        vf.add_track("Intellivue/ECG_II_clean", recs, SAMPLE_RATE, "mV", ECG_MIN_THRESHOLD, ECG_MAX_THRESHOLD)
+        results['ecg_clean'] = ecg_clean
 
     if ecg_clean is not None:
         # Calculate ANI if ECG is valid
@@ -54,28 +71,27 @@ def process_file(file_path):
         if error:
             print(error)
         else:
-            recs = [{'dt': vf.dtstart + 64, 'val': ANI}]
-            vf.add_track("ANIMonitor2/custom_ANI", recs, 1, "", 0, 100)
+            results['ANI'] = ANI
 
     # Prepare PPG data
     ppg, ppg_clean, error = prepare_ppg(
-        file_path,
+        ppg,
         sample_rate=SAMPLE_RATE,
         nan_threshold=NAN_THRESHOLD,
         max_threshold=PPG_MAX_THRESHOLD,
-        min_threshold=PPG_MIN_THRESHOLD
+        min_threshold=PPG_MIN_THRESHOLD,
+        file_path=header.ipath
     )
     
     if error:
         print(error)
     else:
-        recs = chunk_data_for_track(ppg_clean, vf, SAMPLE_RATE)
-        vf.add_track("Intellivue/PLETH_clean", recs, SAMPLE_RATE, "", PPG_MIN_THRESHOLD, PPG_MAX_THRESHOLD)
+        results['ppg_clean'] = ppg_clean
     
     # Calculate SPI if PPG is valid and SPI module is available
     if ppg_clean is not None and f_spi is not None:
         mean_spi, min_spi, spi, error = calculate_spi(
-            file_path, 
+            header, 
             ppg_clean, 
             f_spi, 
             sample_rate=SAMPLE_RATE, 
@@ -84,16 +100,96 @@ def process_file(file_path):
         if error:
             print(error)
         else:
-            recs = [{'dt': vf.dtstart, 'val': spi}]
-            vf.add_track("ANIMonitor2/custom_SPI", recs, 1, "", 0, 100)
+            results['spi'] = spi
+    return results
+
+
+def save_file(vf, results, file_path):
+    """Add the derived tracks to the VitalFile and write it to OUTPUT_DIR (I/O stage)"""
+    if results['ecg_clean'] is not None:
+        recs = chunk_data_for_track(results['ecg_clean'], vf, SAMPLE_RATE)
+        vf.add_track("Intellivue/ECG_II_clean", recs, SAMPLE_RATE, "mV", ECG_MIN_THRESHOLD, ECG_MAX_THRESHOLD)
+
+    if results['ANI'] is not None:
+        recs = [{'dt': vf.dtstart + 64, 'val': results['ANI']}]
+        vf.add_track("ANIMonitor2/custom_ANI", recs, 1, "", 0, 100)
+
+    if results['ppg_clean'] is not None:
+        recs = chunk_data_for_track(results['ppg_clean'], vf, SAMPLE_RATE)
+        vf.add_track("Intellivue/PLETH_clean", recs, SAMPLE_RATE, "", PPG_MIN_THRESHOLD, PPG_MAX_THRESHOLD)
+
+    if results['spi'] is not None:
+        recs = [{'dt': vf.dtstart, 'val': results['spi']}]
+        vf.add_track("ANIMonitor2/custom_SPI", recs, 1, "", 0, 100)
     # Generate output filename
-    output_filename = os.path.join(OUTPUT_DIR, file_name)
+    output_filename = os.path.join(OUTPUT_DIR, os.path.basename(file_path))
 
     # Save the VitalFile with processed data
     vf.to_vital(output_filename)
     print(f"Saved processed vital file to {output_filename}")
 
 
+def process_file(file_path):
+    """Process a single vital file to calculate HRV, SPI, and ANI"""
+    vf, ecg, ppg = load_file(file_path)
+    results = compute_tracks(copy_header(vf), ecg, ppg)
+    save_file(vf, results, file_path)
+
+
+def init_worker(num_threads):
+    """Process pool initializer: limit the worker's Numba threads and warm up the ANI kernels"""
+    numba.set_num_threads(num_threads)
+    warmup_ani(SAMPLE_RATE)
+
+
+def process_files(file_paths, workers):
+    """
+    Process vital files through a load -> compute -> save pipeline.
+
+    Loading and saving run on a small thread pool while the ANI/SPI computation runs on
+    a process pool, so one file's disk I/O overlaps another file's computation. At most
+    workers + IO_WORKERS files are held in memory at a time. Each worker parallelizes its
+    ANI windows over an equal share of the cores.
+
+    Workers are spawned rather than forked: the first submit happens while the I/O threads
+    are running, and forking a multi-threaded process can deadlock the child.
+    """
+    pending = iter(file_paths)
+    stages = {}  # future -> (stage, file_path, vf)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=IO_WORKERS) as io_pool, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                   mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=init_worker,
+                                                   initargs=(max(1, numba.config.NUMBA_NUM_THREADS // workers),)) as cpu_pool:
+        def load_next():
+            file_path = next(pending, None)
+            if file_path is not None:
+                stages[io_pool.submit(load_file, file_path)] = ('load', file_path, None)
+
+        for _ in range(workers + IO_WORKERS):
+            load_next()
+
+        while stages:
+            done, _ = concurrent.futures.wait(stages, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage, file_path, vf = stages.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error processing {os.path.basename(file_path)}: {str(e)}")
+                    load_next()
+                    continue
+
+                if stage == 'load':
+                    vf, ecg, ppg = result
+                    stages[cpu_pool.submit(compute_tracks, copy_header(vf), ecg, ppg)] = ('compute', file_path, vf)
+                elif stage == 'compute':
+                    stages[io_pool.submit(save_file, vf, result, file_path)] = ('save', file_path, None)
+                else:
+                    load_next()
+
+
 def main():
     """Main function to process all vital files"""
     # Parse command-line arguments
@@ -115,9 +211,7 @@ def main():
     
     # Process files in parallel
     file_paths = [os.path.join(DATA_DIR, f) for f in files]
-    
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
-        executor.map(process_file, file_paths)
+    process_files(file_paths, args.workers)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
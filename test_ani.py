@@ -0,0 +1,31 @@
+"""
+Equivalence checks for the hand-written Numba filters against the scipy and NeuroKit reference implementations
+"""
+import numpy as np
+import neurokit2 as nk
+import pytest
+from scipy.signal import butter, sosfiltfilt, sosfilt_zi
+
+from ani import bandpass_coefs, clean_ecg, _sosfiltfilt
+
+
+@pytest.mark.parametrize("sos", [
+    bandpass_coefs(4)[0],
+    butter(5, 0.5, btype='highpass', output='sos', fs=100),
+    butter(3, [1, 40], btype='band', output='sos', fs=250),
+])
+def test_sosfiltfilt_matches_scipy(sos):
+    x = np.random.default_rng(0).standard_normal(2000).astype(np.float32)
+    expected = sosfiltfilt(sos, x.astype(np.float64))
+    result = _sosfiltfilt(sos, sosfilt_zi(sos), x)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize("sample_rate", [100, 250, 500])
+def test_clean_ecg_matches_neurokit(sample_rate):
+    ecg = nk.ecg_simulate(duration=30, sampling_rate=sample_rate, noise=0.05, random_state=0).astype(np.float32)
+    expected = nk.ecg_clean(ecg, sampling_rate=sample_rate)
+    result = clean_ecg(ecg, sample_rate)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
@@ -5,7 +5,34 @@ import numpy as np
 import vitaldb
 import math
 import neurokit2 as nk
-from ani import calculate_area_segment
+from numba import njit
+from ani import bandpass_coefs, clean_ecg, compute_ani_all
+
+@njit('i8(f4[:], f8, f8, b1)', cache=True)
+def _sanitize_samples(x, min_threshold, max_threshold, clip):
+    """
+    Replace NaNs with 0 and out-of-range samples with 0 (or clip them to range), in place and in one pass.
+    
+    Args:
+        x: The signal to clean in place
+        min_threshold, max_threshold: Valid sample range
+        clip: Clip out-of-range samples to the range instead of zeroing them
+        
+    Returns:
+        Number of NaN samples found
+    """
+    nan_count = 0
+    for i in range(len(x)):
+        v = x[i]
+        if np.isnan(v):
+            nan_count += 1
+            v = 0.
+        if clip:
+            v = min(max(v, min_threshold), max_threshold)
+        elif v >= max_threshold or v <= min_threshold:
+            v = 0.
+        x[i] = v
+    return nan_count
 
 def chunk_data_for_track(data, vf, sample_rate=100):
     """
@@ -19,61 +46,82 @@ def chunk_data_for_track(data, vf, sample_rate=100):
     Returns:
         List of record dictionaries with timestamps and values
     """
-    recs = []
     chunk_size = int(sample_rate)
-    for istart in range(0, len(data), chunk_size):
-        end_idx = min(istart + chunk_size, len(data))
-        recs.append({
-            'dt': vf.dtstart + istart / sample_rate, 
-            'val': data[istart:end_idx]
-        })
-    return recs
+    n_full = len(data) // chunk_size
+    # Whole chunks are rows of a reshaped view; only a trailing partial chunk is sliced
+    chunks = list(data[:n_full * chunk_size].reshape(n_full, chunk_size))
+    if len(data) > n_full * chunk_size:
+        chunks.append(data[n_full * chunk_size:])
+    dts = vf.dtstart + np.arange(0, len(data), chunk_size) / sample_rate
+    return [{'dt': dt, 'val': val} for dt, val in zip(dts.tolist(), chunks)]
 
-def prepare_ecg(file_path, sample_rate=100, nan_threshold=0.5, 
-                max_threshold=3.0, min_threshold=-1.0):
-    """Prepare ECG data for HRV and ANI calculations"""
+def copy_header(vf):
+    """
+    Create a track-less VitalFile covering the same time range as vf.
+    
+    Args:
+        vf: VitalFile instance to take dtstart, dtend, dgmt and ipath from
+        
+    Returns:
+        New VitalFile with no devices or tracks
+    """
+    header = vitaldb.VitalFile()
+    header.dtstart, header.dtend, header.dgmt = vf.dtstart, vf.dtend, vf.dgmt
+    header.ipath = vf.ipath  # Keeps error messages pointing at the source file
+    return header
+
+def load_signals(vf, sample_rate=100):
+    """
+    Extract the ECG and PPG waveforms from a VitalFile in a single to_numpy call.
+    
+    Args:
+        vf: VitalFile instance to read from
+        sample_rate: The sample rate to resample both tracks to
+        
+    Returns:
+        Tuple of (ecg, ppg) arrays of equal length
+    """
+    signals = vf.to_numpy(['Intellivue/ECG_II', 'Intellivue/PLETH'], 1/sample_rate).astype(np.float32, copy=False)
+    return signals[:, 0], signals[:, 1]
+
+def prepare_ecg(ecg, sample_rate=100, nan_threshold=0.5, 
+                max_threshold=3.0, min_threshold=-1.0, file_path=None):
+    """Prepare ECG data for HRV and ANI calculations; file_path only labels error messages"""
     try:
-        vf = vitaldb.VitalFile(file_path)
-        ecg = vf.to_numpy('Intellivue/ECG_II', 1/sample_rate)
         # Check data length
         if len(ecg) == 0:
             return None, None, "No ECG data found"
         
+        # Clean ECG data, counting NaN values in the same pass
+        nan_count = _sanitize_samples(ecg, min_threshold, max_threshold, False)
+        
         # Check for too many NaN values
-        nan_count = np.isnan(ecg).sum()
         if nan_count > len(ecg) * nan_threshold:
             return None, None, f"Too many NaN values in ECG: {nan_count}/{len(ecg)} ({nan_count/len(ecg):.2%})"
         
-        # Clean ECG data
-        ecg[np.isnan(ecg)] = 0.
-        idx_abn = (ecg >= max_threshold) | (ecg <= min_threshold)
-        ecg[idx_abn] = 0.
-        ecg_clean = nk.ecg_clean(ecg, sampling_rate=sample_rate).astype(np.float32)
+        # NaNs were zeroed above, so NeuroKit's missing-data handling is not needed
+        ecg_clean = clean_ecg(ecg, sample_rate)
 
         return ecg, ecg_clean, None
     except Exception as e:
         print(f"Error preparing ECG from {file_path}: {str(e)}")
         return None, None, f"Error preparing ECG: {str(e)}"
 
-def prepare_ppg(file_path, sample_rate=100, nan_threshold=0.5,
-                max_threshold=100.0, min_threshold=0.0):
-    """Prepare PPG data for SPI calculation"""
+def prepare_ppg(ppg, sample_rate=100, nan_threshold=0.5,
+                max_threshold=100.0, min_threshold=0.0, file_path=None):
+    """Prepare PPG data for SPI calculation; file_path only labels error messages"""
     try:
-        vf = vitaldb.VitalFile(file_path)
-        ppg = vf.to_numpy('Intellivue/PLETH', 1/sample_rate)
-        
         # Check data length
         if len(ppg) == 0:
             return None, None, "No PPG data found"
         
+        # Clean PPG data, counting NaN values in the same pass
+        nan_count = _sanitize_samples(ppg, min_threshold, max_threshold, True)
+        
         # Check for too many NaN values
-        nan_count = np.isnan(ppg).sum()
         if nan_count > len(ppg) * nan_threshold:
             return None, None, f"Too many NaN values in PPG: {nan_count}/{len(ppg)} ({nan_count/len(ppg):.2%})"
         
-        # Clean PPG data
-        ppg[np.isnan(ppg)] = 0.
-        ppg = np.clip(ppg, min_threshold, max_threshold)
         ppg_clean = nk.ppg_clean(ppg, sampling_rate=sample_rate, method=None).astype(np.float32)
         
         return ppg, ppg_clean, None
@@ -81,28 +129,26 @@ def prepare_ppg(file_path, sample_rate=100, nan_threshold=0.5,
         print(f"Error preparing PPG from {file_path}: {str(e)}")
         return None, None, f"Error preparing PPG: {str(e)}"
 
-def calculate_spi(file_path, ppg_clean, f_spi, sample_rate=100, color_blue=3634859):
+def calculate_spi(vf, ppg_clean, f_spi, sample_rate=100, color_blue=3634859):
     """Calculate SPI from cleaned PPG data"""
     if f_spi is None:
         return None, None, "SPI calculation module not available"
     
     try:
-        vf = vitaldb.VitalFile(file_path)
-        
-        # Remove existing tracks if they exist
-        vf.remove_track('Intellivue/PLETH')
-        vf.remove_track('Intellivue/ECG_II')
+        # run_filter adds tracks to the file it runs on, so run it on a scratch
+        # VitalFile spanning the same time range instead of the caller's vf
+        vf_spi = copy_header(vf)
 
         # Call the function to get chunked data
-        recs = chunk_data_for_track(ppg_clean, vf, sample_rate)
+        recs = chunk_data_for_track(ppg_clean, vf_spi, sample_rate)
         
-        vf.add_track('PLETH', recs, srate=sample_rate, mindisp=0, maxdisp=100, col=color_blue)
+        vf_spi.add_track('PLETH', recs, srate=sample_rate, mindisp=0, maxdisp=100, col=color_blue)
         
         # Run SPI filter
-        vf.run_filter(f_spi.run, f_spi.cfg)
+        vf_spi.run_filter(f_spi.run, f_spi.cfg)
         
         # Extract SPI values
-        spi = vf.to_numpy('SPI', 1).flatten()
+        spi = vf_spi.to_numpy('SPI', 1).flatten()
         # Interpolate NaN values in SPI data
         if np.any(np.isnan(spi)):
             # Find indices of non-NaN values
@@ -126,36 +172,39 @@ def calculate_spi(file_path, ppg_clean, f_spi, sample_rate=100, color_blue=36348
         
         return mean_spi, min_spi, spi, None
     except Exception as e:
-        print(f"Error calculating SPI from {file_path}: {str(e)}")
+        print(f"Error calculating SPI from {vf.ipath}: {str(e)}")
         return None, None, None, f"Error calculating SPI: {str(e)}"
 
+def warmup_ani(sample_rate=100, fs_interp=4):
+    """Run ANI on a dummy recording so a worker process has its kernels and filter design ready, e.g. as a pool initializer"""
+    sos, zi = bandpass_coefs(fs_interp)
+    n_samples = 65 * sample_rate
+    compute_ani_all(np.arange(0, n_samples, sample_rate), np.zeros(n_samples + 1, dtype=np.int64),
+                    sample_rate, fs_interp, sos, zi)
+
 def calculate_ani(ecg_clean, sample_rate=100, fs_interp=4):
     """Calculate ANI from cleaned ECG data"""
-    L_W = 64 * sample_rate  # 64-second window
     L_B = 16 * fs_interp  # 16-second window
     
     Lecg_sec = math.floor(len(ecg_clean)/sample_rate)
     if Lecg_sec <= 64:
         return None, "ECG recording too short for ANI calculation (< 64 seconds)"
 
-    # Calculate area between envelopes (normalized to 16-second window)
-    ANI = []
-    for i in range(Lecg_sec):
-        start_idx = i * sample_rate
-        ecg64 = ecg_clean[start_idx:start_idx+L_W+1]
-        try:
-            _, info_pk = nk.ecg_peaks(ecg64, sampling_rate=sample_rate)
-            upper_envelope, lower_envelope, _ = calculate_area_segment(info_pk["ECG_R_Peaks"], sample_rate, fs_interp) # AUC_total
-            areas = []
-            # for j in range(4):
-            #     area = np.trapz(upper_envelope[j*L_B:(j+1)*L_B+1] - lower_envelope[j*L_B:(j+1)*L_B+1], dx=1/fs_interp)
-            #     areas.append(area.item())
-            # ANI.append(100 * (5.1 * min(areas) + 1.2) / 12.8)
-            area = np.trapz(upper_envelope - lower_envelope, dx=1/fs_interp)
-            areas.append(area.item())
-            ANI.append(100 * sum(areas) / 12.8)
-        except:
-            ANI.append(0)
-    ANI = np.array(ANI, dtype=np.float32)
+    # Detect R peaks once over the whole recording; each window takes its slice
+    _, info_pk = nk.ecg_peaks(ecg_clean, sampling_rate=sample_rate)
+    peaks = np.asarray(info_pk["ECG_R_Peaks"], dtype=np.int64)
+
+    sos, zi = bandpass_coefs(fs_interp)
+
+    # Running count of non-finite samples, so each window can be checked in O(1)
+    nonfinite = np.concatenate(([0], np.cumsum(~np.isfinite(ecg_clean))))
+
+    # Calculate area between envelopes (normalized to 16-second window), all windows in parallel
+    areas = compute_ani_all(peaks, nonfinite, sample_rate, fs_interp, sos, zi) # AUC_total
+    # for j in range(4):
+    #     area = np.trapz(upper_envelope[j*L_B:(j+1)*L_B+1] - lower_envelope[j*L_B:(j+1)*L_B+1], dx=1/fs_interp)
+    #     areas.append(area.item())
+    # ANI.append(100 * (5.1 * min(areas) + 1.2) / 12.8)
+    ANI = (100 * areas / 12.8).astype(np.float32)
     ANI[np.isnan(ANI)] = 0
     return ANI, None
\ No newline at end of file